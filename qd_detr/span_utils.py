@@ -1,4 +1,5 @@
 import torch
+import torch.nn.functional as F
 
 
 def span_xx_to_cxw(xx_spans):
@@ -17,9 +18,10 @@ def span_xx_to_cxw(xx_spans):
     tensor([[[0.5000, 1.0000],
          [0.3000, 0.2000]]])
     """
-    center = xx_spans.sum(-1) * 0.5
-    width = xx_spans[..., 1] - xx_spans[..., 0]
-    return torch.stack([center, width], dim=-1)
+    cxw_spans = xx_spans.new_empty(xx_spans.shape)
+    cxw_spans[..., 0] = xx_spans.sum(-1) * 0.5
+    cxw_spans[..., 1] = xx_spans[..., 1] - xx_spans[..., 0]
+    return cxw_spans
 
 
 def span_cxw_to_xx(cxw_spans):
@@ -36,26 +38,30 @@ def span_cxw_to_xx(cxw_spans):
     tensor([[[0.0000, 1.0000],
         [0.2000, 0.4000]]])
     """
-    x1 = cxw_spans[..., 0] - 0.5 * cxw_spans[..., 1]
-    x2 = cxw_spans[..., 0] + 0.5 * cxw_spans[..., 1]
-    return torch.stack([x1, x2], dim=-1)
+    half_w = 0.5 * cxw_spans[..., 1]
+    xx_spans = cxw_spans.new_empty(cxw_spans.shape)
+    xx_spans[..., 0] = cxw_spans[..., 0] - half_w
+    xx_spans[..., 1] = cxw_spans[..., 0] + half_w
+    return xx_spans
 
 def span_cxw_to_window(cxw_spans, durations, batch_idx, clip_length=2):
     bsz, batch_idx = batch_idx
 
     xx_spans = span_cxw_to_xx(cxw_spans)
-    xx_spans = torch.cat([span * durations[i] for i, span in enumerate(xx_spans)], dim=0)
-    xx_spans = torch.clamp(xx_spans, min=0, max=150)
+    # durations has one entry per sample, not per span; pick each span's
+    # sample duration through batch_idx
+    l_clips = xx_spans.new_tensor(durations)[batch_idx.to(xx_spans.device)]
+    xx_spans = xx_spans * l_clips.unsqueeze(-1)
+    xx_spans.clamp_(min=0, max=150)
 
-    windows = torch.round(xx_spans / clip_length) * clip_length
+    windows = xx_spans.div(clip_length).round_().mul_(clip_length)
 
     b_windows = [[] for i in range(bsz)]
 
-    for b, i in enumerate(batch_idx):
-        b_windows[i].append(windows[b])
+    windows_list = windows.tolist()
+    for b, i in enumerate(batch_idx.tolist()):
+        b_windows[i].append(windows_list[b])
 
-    print(b_windows)
-    
     return b_windows
 
 def temporal_iou(spans1, spans2):
@@ -88,6 +94,31 @@ def temporal_iou(spans1, spans2):
     return iou, union
 
 
+def temporal_iou_paired(spans1, spans2):
+    """Row-wise IoU for 1:1 matched spans, i.e. the diagonal of
+    temporal_iou(spans1, spans2) without building the (N, M) map.
+
+    Args:
+        spans1: (N, 2) torch.Tensor, each row defines a span [st, ed]
+        spans2: (N, 2) torch.Tensor, matched row for row
+
+    Returns:
+        iou: (N, ) torch.Tensor
+        union: (N, ) torch.Tensor
+    """
+    areas1 = spans1[:, 1] - spans1[:, 0]  # (N, )
+    areas2 = spans2[:, 1] - spans2[:, 0]  # (N, )
+
+    left = torch.maximum(spans1[:, 0], spans2[:, 0])  # (N, )
+    right = torch.minimum(spans1[:, 1], spans2[:, 1])  # (N, )
+
+    inter = (right - left).clamp(min=0)  # (N, )
+    union = areas1 + areas2 - inter  # (N, )
+
+    iou = inter / union
+    return iou, union
+
+
 def temporal_intersection_over_pred(gt_spans, pred_spans):
     """ intersection over the second input spans
     Args:
@@ -124,118 +155,142 @@ def generalized_temporal_iou(spans1, spans2):
     tensor([[ 0.6667,  0.2000],
         [-0.2000,  0.5000]])
     """
-    spans1 = spans1.float()
-    spans2 = spans2.float()
+    if spans1.dtype != torch.float32:
+        spans1 = spans1.float()
+    if spans2.dtype != torch.float32:
+        spans2 = spans2.float()
     assert (spans1[:, 1] >= spans1[:, 0]).all()
     assert (spans2[:, 1] >= spans2[:, 0]).all()
-    iou, union = temporal_iou(spans1, spans2)
 
-    left = torch.min(spans1[:, None, 0], spans2[:, 0])  # (N, M)
-    right = torch.max(spans1[:, None, 1], spans2[:, 1])  # (N, M)
-    enclosing_area = (right - left).clamp(min=0)  # (N, M)
+    # one elementwise min/max pair yields all four boundary maps:
+    # lo = (enclosing_left, inter_right), hi = (inter_left, enclosing_right)
+    lo = torch.minimum(spans1[:, None, :], spans2)  # (N, M, 2)
+    hi = torch.maximum(spans1[:, None, :], spans2)  # (N, M, 2)
+
+    areas1 = spans1[:, 1] - spans1[:, 0]  # (N, )
+    areas2 = spans2[:, 1] - spans2[:, 0]  # (M, )
+
+    inter = (lo[..., 1] - hi[..., 0]).clamp(min=0)  # (N, M)
+    union = areas1[:, None] + areas2 - inter  # (N, M)
+    iou = inter / union
+
+    enclosing_area = (hi[..., 1] - lo[..., 0]).clamp(min=0)  # (N, M)
 
     return iou - (enclosing_area - union) / enclosing_area
 
 
-### When using new loss with pretrain dataset
-### durations of pretrian dataset are various (120 ~ 150)
-def S_Diff(iou, src_spans, tgt_spans, logits):
-    # spans1 = spans1.float()
-    # spans2 = spans2.float()
+def generalized_temporal_iou_paired(spans1, spans2):
+    """Row-wise generalized IoU for 1:1 matched spans, i.e. the diagonal of
+    generalized_temporal_iou(spans1, spans2) without the (N, M) map."""
+    iou, union = temporal_iou_paired(spans1, spans2)
 
-    # iou, union = temporal_iou(spans1, spans2)
+    left = torch.minimum(spans1[:, 0], spans2[:, 0])  # (N, )
+    right = torch.maximum(spans1[:, 1], spans2[:, 1])  # (N, )
+    enclosing_area = (right - left).clamp(min=0)  # (N, )
 
-    # # [spans1, spans2] == [start clip number, end clip number]
-    # spans1 = torch.round(spans1 * 75)
-    # spans2 = torch.round(spans2 * 75)
-    
-    # assert (spans1[:, 1] >= spans1[:, 0]).all()
-    # assert (spans2[:, 1] >= spans2[:, 0]).all()
+    return iou - (enclosing_area - union) / enclosing_area
 
-    bsz, vid_len = logits.shape
 
-    # src_spans = [[] for i in range(bsz)]
-    # tgt_spans = [[] for i in range(bsz)]
+# persistent output buffers for the padded cumsums, keyed by shape/device/
+# dtype so repeated loss calls stop reallocating them; only usable when the
+# input does not require grad, since out= ops are unsupported under autograd
+_cumsum_buffers = {}
 
-    # for b, i in enumerate(idx):
-    #     src_spans[i].append(spans1[b].int().detach().cpu())
-    #     tgt_spans[i].append(spans2[b].int().detach().cpu())
 
-    sim_diffs = []
+def _cumsum_buffer(x, shape):
+    key = (shape, x.device, x.dtype)
+    buf = _cumsum_buffers.get(key)
+    if buf is None:
+        buf = x.new_zeros(shape)
+        _cumsum_buffers[key] = buf
+    return buf
 
-    for i in range(bsz):
-        logit = logits[i]
 
-        for j in range(len(src_spans[i])):
-            
-            st, end = src_spans[i][j]
-            # st, end = min(max(st, 0), vid_len - 1), min(end, vid_len - 1)  # sometimes st is negative or end is larger than max_clip_len
-            if st == end:
-                end += 1
+def _padded_cumsum(logits):
+    """Cumsum over the clip dim with a leading zero, so sums over [st, end) are cs[end] - cs[st]."""
+    if logits.requires_grad:
+        return F.pad(logits.cumsum(dim=-1), (1, 0))
 
-            src_sim = logit[st:end].mean()
-            if torch.isnan(src_sim):
-                print(f'\nsrc: {src_sim},vid_len: {vid_len} \nbefore {src_spans[i][j]}\nafter [{st}, {end}]')
+    bsz, vid_len = logits.shape
+    buf = _cumsum_buffer(logits, (bsz, vid_len + 1))
+    torch.cumsum(logits, dim=-1, out=buf[:, 1:])
+    return buf
 
-            st, end = tgt_spans[i][j]
-            # st, end = min(st, vid_len - 1), min(end, vid_len - 1)   # somtimes there are over-ranged gt window in pretrain dataset
-            if st == end:
-                end += 1
 
-            tgt_sim = logit[st:end].mean()
-            if torch.isnan(tgt_sim):
-                print(f'\ntgt: {tgt_sim}, \nbefore {tgt_spans[i][j]}\nafter [{st}, {end}]\nlogit len: {len(logit)}')
+def _clamped_bounds(st, end, vid_len):
+    """Widen empty spans to one clip and clamp (st, end) into [0, vid_len), end exclusive."""
+    end = torch.where(end == st, end + 1, end).clamp_(min=1, max=vid_len)
+    st = st.clamp(min=0, max=vid_len - 1)
+    return st, end
 
-            sim_diff = torch.abs(src_sim - tgt_sim)  # L1 distance
-            sim_diffs.append(sim_diff) 
 
-    sim_diffs = torch.stack(sim_diffs, dim=0)
+def _span_means(cs, b_idx, st, end):
+    """Mean of logits[b, st:end] for all (b, st, end) triples in two gathers, no Python loop."""
+    vid_len = cs.shape[-1] - 1
+    st, end = _clamped_bounds(st, end, vid_len)
+    sums = cs[b_idx, end] - cs[b_idx, st]
+    return sums / (end - st).float()
 
-    # iou = torch.diag(iou)
-    # new_iou = iou - (1 - iou) * sim_diffs
 
-    sim_diff_term = (1 - iou) * sim_diffs
+def _padded_cumsum2d(v2v_sims):
+    """2-D summed-area table with zero padding, so any rectangle sum is four gathers."""
+    if v2v_sims.requires_grad:
+        return F.pad(v2v_sims.cumsum(1).cumsum(2), (1, 0, 1, 0))
 
-    return sim_diff_term
+    bsz, vid_len = v2v_sims.shape[:2]
+    buf = _cumsum_buffer(v2v_sims, (bsz, vid_len + 1, vid_len + 1))
+    sub = buf[:, 1:, 1:]
+    torch.cumsum(v2v_sims, dim=1, out=sub)
+    sub.cumsum_(dim=2)
+    return buf
+
+
+def _rect_sums(ii, b_idx, r0, r1, c0, c1):
+    """Sum of v2v_sims[b, r0:r1, c0:c1] for all index tuples (ends exclusive)."""
+    return ii[b_idx, r1, c1] - ii[b_idx, r0, c1] - ii[b_idx, r1, c0] + ii[b_idx, r0, c0]
 
 
-def S_GT_P(iou, src_spans, tgt_spans, v2v_sims):  # S(Gt-P)
-    bsz, vid_len, _ = v2v_sims.shape
+### When using new loss with pretrain dataset
+### durations of pretrian dataset are various (120 ~ 150)
+def S_Diff(iou, b_idx, src_spans, tgt_spans, logits, cs=None):
+    # spans1 = spans1.float()
+    # spans2 = spans2.float()
 
-    # src_spans = [[] for i in range(bsz)]
-    # tgt_spans = [[] for i in range(bsz)]
+    # iou, union = temporal_iou(spans1, spans2)
 
-    # for b, i in enumerate(idx):
-    #     src_spans[i].append(spans1[b].int().detach().cpu())
-    #     tgt_spans[i].append(spans2[b].int().detach().cpu())
+    # # [spans1, spans2] == [start clip number, end clip number]
+    # spans1 = torch.round(spans1 * 75)
+    # spans2 = torch.round(spans2 * 75)
+    
+    # assert (spans1[:, 1] >= spans1[:, 0]).all()
+    # assert (spans2[:, 1] >= spans2[:, 0]).all()
 
-    i2i_sims = []
-    for i in range(bsz):
-        v2v_sim = v2v_sims[i]
+    if cs is None:
+        cs = _padded_cumsum(logits)
+    src_sims = _span_means(cs, b_idx, src_spans[:, 0], src_spans[:, 1])
+    tgt_sims = _span_means(cs, b_idx, tgt_spans[:, 0], tgt_spans[:, 1])
 
-        for j in range(len(src_spans[i])):
-            
-            st, end = src_spans[i][j]
-            if st == end:
-                end += 1
-            # st, end = min(max(st, 0), vid_len - 1), min(end, vid_len - 1)  # sometime st is negative value
-            # src_feat = vid_feat[st:end + 1].mean(dim=0)
-            i2i_sim = v2v_sim[st: end, :]
+    sim_diffs = torch.abs(src_sims - tgt_sims)  # L1 distance
+
+    # iou = torch.diag(iou)
+    # new_iou = iou - (1 - iou) * sim_diffs
+
+    sim_diff_term = (1 - iou) * sim_diffs
+
+    return sim_diff_term
 
-            st, end = tgt_spans[i][j]
-            if st == end:
-                end += 1
-            # st, end = min(st, vid_len - 1), min(end, vid_len - 1)
-            # tgt_feat = vid_feat[st:end + 1].mean(dim=0)
-            i2i_sim = i2i_sim[:, st: end]
 
-            i2i_sim = i2i_sim.flatten().mean()
+def S_GT_P(iou, b_idx, src_spans, tgt_spans, v2v_sims, ii=None):  # S(Gt-P)
+    vid_len = v2v_sims.shape[1]
 
-            # i2i_sim = src_feat @ tgt_feat.t()
-            # i2i_sims.append(i2i_sim)
-            i2i_sims.append(i2i_sim)
+    r0, r1 = _clamped_bounds(src_spans[:, 0], src_spans[:, 1], vid_len)
+    c0, c1 = _clamped_bounds(tgt_spans[:, 0], tgt_spans[:, 1], vid_len)
 
-    i2i_sims = torch.stack(i2i_sims, dim=0)
+    # mean of v2v_sim[src, tgt] for every span pair via one summed-area table
+    if ii is None:
+        ii = _padded_cumsum2d(v2v_sims)
+    sums = _rect_sums(ii, b_idx, r0, r1, c0, c1)
+    i2i_sims = sums / ((r1 - r0) * (c1 - c0)).float()
 
     # iou = torch.diag(iou)
     # new_iou = iou - (1 - iou) * (1 - i2i_sims)
@@ -244,7 +299,7 @@ def S_GT_P(iou, src_spans, tgt_spans, v2v_sims):  # S(Gt-P)
 
     return sim_gt_p_term
 
-def S_Q_P(iou, src_spans, logits):  # S(Q-P)
+def S_Q_P(iou, b_idx, src_spans, logits, cs=None):  # S(Q-P)
     # spans1 = spans1.float()
     # spans2 = spans2.float()
 
@@ -255,29 +310,9 @@ def S_Q_P(iou, src_spans, logits):  # S(Q-P)
     
     # assert (spans[:, 1] >= spans[:, 0]).all()
 
-    bsz, vid_len = logits.shape
-
-    # src_spans = [[] for i in range(bsz)]
-
-    # for b, i in enumerate(idx):
-    #     src_spans[i].append(spans[b].int().detach().cpu())
-
-    t2i_sims = []
-    # src_sims = []
-    for i in range(bsz):
-        logit = logits[i]
-
-        for j in range(len(src_spans[i])):
-        
-            st, end = src_spans[i][j]
-            if st == end:
-                end += 1
-            # st, end = min(max(st, 0), vid_len - 1), min(end, vid_len - 1)  # sometime st is negative value
-            src_sim = logit[st:end].mean()
-
-            t2i_sims.append(src_sim)
-
-    t2i_sims = torch.stack(t2i_sims, dim=0)
+    if cs is None:
+        cs = _padded_cumsum(logits)
+    t2i_sims = _span_means(cs, b_idx, src_spans[:, 0], src_spans[:, 1])
 
     # iou = torch.diag(iou)
     # new_iou = iou - (1 - iou) * (1 - t2i_sims)
@@ -287,90 +322,80 @@ def S_Q_P(iou, src_spans, logits):  # S(Q-P)
     return sim_p_q_term
 
 def distance_term(spans1, spans2):
-    left = torch.min(spans1[:, None, 0], spans2[:, 0])  # (N, M)
-    right = torch.max(spans1[:, None, 1], spans2[:, 1])  # (N, M)
-    
-    enclosing_area = torch.diag((right - left).clamp(min=0))  # (N, M)
+    # only the matched diagonal is used, so everything stays elementwise (N, )
+    left = torch.minimum(spans1[:, 0], spans2[:, 0])  # (N, )
+    right = torch.maximum(spans1[:, 1], spans2[:, 1])  # (N, )
+
+    enclosing_area = (right - left).clamp(min=0)  # (N, )
 
-    center1 = torch.diag((spans1[:, None, 0] + spans1[:, None, 1]) / 2)
-    center2 = (spans2[:, 0] + spans2[:, 1]) / 2
+    center1 = span_xx_to_cxw(spans1)[:, 0]
+    center2 = span_xx_to_cxw(spans2)[:, 0]
     center_dist = torch.abs(center2 - center1)
 
     distance = center_dist / (enclosing_area ** 2)
 
     return distance
 
-def S_GT_P_scaled(iou, src_spans, tgt_spans, v2v_sims):  # S(Gt-P)
-    bsz, vid_len, _ = v2v_sims.shape
+def S_GT_P_scaled(iou, b_idx, src_spans, tgt_spans, v2v_sims, ii=None):  # S(Gt-P)
+    vid_len = v2v_sims.shape[1]
 
-    i2i_sims = []
-    for i in range(bsz):
-        src_span = src_spans[i]
-        tgt_span = tgt_spans[i]
-        v2v_sim = v2v_sims[i]
+    r0, r1 = _clamped_bounds(src_spans[:, 0], src_spans[:, 1], vid_len)
+    c0, c1 = _clamped_bounds(tgt_spans[:, 0], tgt_spans[:, 1], vid_len)
 
-        for j in range(len(src_span)):
-            src_start, src_end = src_span[j]
-            src_end = src_end + 1 if src_start == src_end else src_end
-            tgt_start, tgt_end = tgt_span[j]
-            tgt_end = tgt_end + 1 if tgt_start == tgt_end else tgt_end
+    # rectangle sums minus the gt self-similarity diagonal, all batched
+    if ii is None:
+        ii = _padded_cumsum2d(v2v_sims)
+    diag_cs = F.pad(v2v_sims.diagonal(dim1=1, dim2=2).cumsum(-1), (1, 0))
 
-            # i2i_sim = v2v_sim[src_start:src_end, :][:, tgt_start:tgt_end].clone()
-            # i2i_sim /= v2v_sim[tgt_start:tgt_end, tgt_start:tgt_end].diag().repeat(i2i_sim.size(0), 1)
-            # Compute mean and append to i2i_sims
-            # i2i_sims.append(i2i_sim.flatten().mean())
-
-            i2i_sim = v2v_sim[src_start:src_end, :][:, tgt_start:tgt_end].sum()
-            i2i_sim -= v2v_sim[tgt_start:tgt_end, tgt_start:tgt_end].diag().sum()
-            # Compute mean and append to i2i_sims
-            i2i_sims.append(i2i_sim / ((src_end - src_start) * (tgt_end - tgt_start)))
-
-    # Stack i2i_sims
-    i2i_sims = torch.stack(i2i_sims, dim=0)
-    # print(f'i2i_sims: {i2i_sims.shape}\n{i2i_sims}')
+    sums = _rect_sums(ii, b_idx, r0, r1, c0, c1)
+    sums = sums - (diag_cs[b_idx, c1] - diag_cs[b_idx, c0])
+    i2i_sims = sums / ((r1 - r0) * (c1 - c0)).float()
 
     sim_gt_p_term = (1 - iou) * (1 - i2i_sims)
 
     return sim_gt_p_term
 
-def S_GT_P_both(iou, src_spans, tgt_spans, v2v_sims):  # S(Gt-P)
-    bsz, vid_len, _ = v2v_sims.shape
-
-    i2i_sims = []
-    
-    for i in range(bsz):
-        src_span = src_spans[i]
-        tgt_span = tgt_spans[i]
-        v2v_sim = v2v_sims[i]
-
-        for j in range(len(src_span)):
-            src_start, src_end = src_span[j]
-            src_end = src_end + 1 if src_start == src_end else src_end
-            tgt_start, tgt_end = tgt_span[j]
-            tgt_end = tgt_end + 1 if tgt_start == tgt_end else tgt_end
+def S_GT_P_both(iou, b_idx, src_spans, tgt_spans, v2v_sims, ii=None):  # S(Gt-P)
+    vid_len = v2v_sims.shape[1]
 
-            i2i_sim_per_pred = v2v_sim[src_start:src_end, :][:, tgt_start:tgt_end].flatten()
-            i2i_sim_per_gt = v2v_sim[tgt_start:tgt_end, :][:, src_start:src_end].flatten()
+    r0, r1 = _clamped_bounds(src_spans[:, 0], src_spans[:, 1], vid_len)
+    c0, c1 = _clamped_bounds(tgt_spans[:, 0], tgt_spans[:, 1], vid_len)
 
-            # Compute mean and append to i2i_sims
-            i2i_sims.append(torch.cat((i2i_sim_per_pred, i2i_sim_per_gt)).mean())
-
-    # Stack i2i_sims
-    i2i_sims = torch.stack(i2i_sims, dim=0)
-    # print(f'i2i_sims: {i2i_sims.shape}\n{i2i_sims}')
+    # mean over the pred->gt and gt->pred rectangles together; both have the same area
+    if ii is None:
+        ii = _padded_cumsum2d(v2v_sims)
+    sums = _rect_sums(ii, b_idx, r0, r1, c0, c1) + _rect_sums(ii, b_idx, c0, c1, r0, r1)
+    i2i_sims = sums / (2 * (r1 - r0) * (c1 - c0)).float()
 
     sim_gt_p_term = (1 - iou) * (1 - i2i_sims)
 
     return sim_gt_p_term
 
+# compile the hot per-span terms when supported (PyTorch >= 2.0) so the
+# gather/cumsum assembly runs as a few fused kernels instead of many small
+# eager ops; eager fallback is unchanged on older torch
+if hasattr(torch, 'compile'):
+    S_Diff = torch.compile(S_Diff, dynamic=True)
+    S_GT_P = torch.compile(S_GT_P, dynamic=True)
+    S_GT_P_scaled = torch.compile(S_GT_P_scaled, dynamic=True)
+    S_GT_P_both = torch.compile(S_GT_P_both, dynamic=True)
+    S_Q_P = torch.compile(S_Q_P, dynamic=True)
+
+
 def new_loss(iou_loss_types, spans1, spans2, sims, idx, durations):
-    spans1 = spans1.float()
-    spans2 = spans2.float()
+    # the matcher builds idx on CPU from the numpy assignment; move it once
+    # so every gather below and the bincount run on the spans' device
+    idx = idx.to(spans1.device, non_blocking=True)
 
-    new_loss = 1 - torch.diag(generalized_temporal_iou(spans1, spans2))
+    if spans1.dtype != torch.float32:
+        spans1 = spans1.float()
+    if spans2.dtype != torch.float32:
+        spans2 = spans2.float()
 
-    iou, _ = temporal_iou(spans1, spans2)
-    iou = torch.diag(iou)
+    # spans are matched 1:1 here, so only the paired O(N) terms are needed
+    new_loss = 1 - generalized_temporal_iou_paired(spans1, spans2)
+
+    iou, _ = temporal_iou_paired(spans1, spans2)
 
     # if not 2 in iou_loss_types:
     #     sims = sims[0]
@@ -395,40 +420,48 @@ def new_loss(iou_loss_types, spans1, spans2, sims, idx, durations):
     assert (spans1[:, 1] >= spans1[:, 0]).all()
     assert (spans2[:, 1] >= spans2[:, 0]).all()
 
-    bsz, vid_clip_len = sims.shape[:2]
+    bsz = sims.shape[0]
 
-    src_spans = [[] for i in range(bsz)]
-    tgt_spans = [[] for i in range(bsz)]
-    
     max_duration = max(durations)
-    for b, i in enumerate(idx):
-        l_clip = durations[i]
+    l_clips = spans1.new_tensor(durations)[idx].unsqueeze(-1)  # (#spans, 1)
 
-        src_spans[i].append(torch.clamp(torch.round(spans1[b] * l_clip), min=0, max=max_duration).int().tolist())
-        tgt_spans[i].append(torch.clamp(torch.round(spans2[b] * l_clip), min=0, max=max_duration).int().tolist())
-        # print(f"l_clip: {l_clip}\tsrc_spans[i]: {src_spans[i][-1]}\ttgt_spans[i]: {tgt_spans[i][-1]}")
-        # src_spans[i].append(spans1[b].int().tolist())
-        # tgt_spans[i].append(spans2[b].int().tolist())
+    # round/clamp the whole batch on device; spans stay on GPU for the S_* terms
+    s1 = (spans1 * l_clips).round_().clamp_(min=0, max=max_duration).long()
+    s2 = (spans2 * l_clips).round_().clamp_(min=0, max=max_duration).long()
 
     # new_loss = 1 - iou
 
+    # the terms share one padded cumsum of the similarity logits
+    cs = _padded_cumsum(sims) if 1 in iou_loss_types or 3 in iou_loss_types else None
+
     if 1 in iou_loss_types:
-        new_loss += S_Diff(iou, src_spans, tgt_spans, sims)
+        new_loss += S_Diff(iou, idx, s1, s2, sims, cs=cs)
 
     if 2 in iou_loss_types:
-        # new_loss += S_GT_P(iou, src_spans, tgt_spans, vid_feat) 
-        new_loss += S_GT_P_scaled(iou, src_spans, tgt_spans, sims)
-    
-    if 3 in iou_loss_types:
-        new_loss += S_Q_P(iou, src_spans, sims)
+        # new_loss += S_GT_P(iou, idx, s1, s2, vid_feat)
+        new_loss += S_GT_P_scaled(iou, idx, s1, s2, sims)
 
-    ### save_pred  
-    ious = [[] for i in range(bsz)]
-    sim_losses = [[] for i in range(bsz)]
-
-    for b, i in enumerate(idx):
-        ious[i].append(iou[b].item())
-        sim_losses[i].append(new_loss[b].item())
+    if 3 in iou_loss_types:
+        new_loss += S_Q_P(iou, idx, s1, sims, cs=cs)
+
+    ### save_pred
+    # idx is sorted by construction (the matcher output is concatenated per
+    # sample), so each sample owns a contiguous run of spans; bincount gives
+    # the run lengths and replaces the per-element bucketing loop
+    counts = torch.bincount(idx, minlength=bsz).cpu().tolist()
+
+    # two device->host transfers for everything: ints together, floats together
+    spans_list = torch.cat([s1, s2], dim=1).cpu().tolist()
+    stats_list = torch.stack([iou, new_loss], dim=1).detach().cpu().tolist()
+
+    src_spans, tgt_spans, ious, sim_losses = [], [], [], []
+    off = 0
+    for n in counts:
+        src_spans.append([row[:2] for row in spans_list[off:off + n]])
+        tgt_spans.append([row[2:] for row in spans_list[off:off + n]])
+        ious.append([row[0] for row in stats_list[off:off + n]])
+        sim_losses.append([row[1] for row in stats_list[off:off + n]])
+        off += n
 
     return new_loss, {'src_spans': src_spans,
                       'tgt_spans': tgt_spans,
@@ -1,4 +1,5 @@
 import torch
+import torch.nn.functional as F
 
 
 def span_xx_to_cxw(xx_spans):
@@ -17,9 +18,10 @@ def span_xx_to_cxw(xx_spans):
     tensor([[[0.5000, 1.0000],
          [0.3000, 0.2000]]])
     """
-    center = xx_spans.sum(-1) * 0.5
-    width = xx_spans[..., 1] - xx_spans[..., 0]
-    return torch.stack([center, width], dim=-1)
+    cxw_spans = xx_spans.new_empty(xx_spans.shape)
+    cxw_spans[..., 0] = xx_spans.sum(-1) * 0.5
+    cxw_spans[..., 1] = xx_spans[..., 1] - xx_spans[..., 0]
+    return cxw_spans
 
 
 def span_cxw_to_xx(cxw_spans):
@@ -36,24 +38,30 @@ def span_cxw_to_xx(cxw_spans):
     tensor([[[0.0000, 1.0000],
         [0.2000, 0.4000]]])
     """
-    x1 = cxw_spans[..., 0] - 0.5 * cxw_spans[..., 1]
-    x2 = cxw_spans[..., 0] + 0.5 * cxw_spans[..., 1]
-    return torch.stack([x1, x2], dim=-1)
+    half_w = 0.5 * cxw_spans[..., 1]
+    xx_spans = cxw_spans.new_empty(cxw_spans.shape)
+    xx_spans[..., 0] = cxw_spans[..., 0] - half_w
+    xx_spans[..., 1] = cxw_spans[..., 0] + half_w
+    return xx_spans
 
 def span_cxw_to_window(cxw_spans, durations, batch_idx, clip_length=2):
     bsz, batch_idx = batch_idx
 
     xx_spans = span_cxw_to_xx(cxw_spans)
-    xx_spans = torch.stack([span * durations[i] for i, span in enumerate(xx_spans)], dim=0)
-    xx_spans = torch.clamp(xx_spans, min=0, max=150)
+    # durations has one entry per sample, not per span; pick each span's
+    # sample duration through batch_idx
+    l_clips = xx_spans.new_tensor(durations)[batch_idx.to(xx_spans.device)]
+    xx_spans = xx_spans * l_clips.unsqueeze(-1)
+    xx_spans.clamp_(min=0, max=150)
 
-    windows = torch.round(xx_spans / clip_length) * clip_length
+    windows = xx_spans.div(clip_length).round_().mul_(clip_length)
 
     b_windows = [[] for i in range(bsz)]
 
-    for b, i in enumerate(batch_idx):
-        b_windows[i].append(windows[b].tolist())
-    
+    windows_list = windows.tolist()
+    for b, i in enumerate(batch_idx.tolist()):
+        b_windows[i].append(windows_list[b])
+
     return b_windows
 
 def temporal_iou(spans1, spans2):
@@ -86,6 +94,31 @@ def temporal_iou(spans1, spans2):
     return iou, union
 
 
+def temporal_iou_paired(spans1, spans2):
+    """Row-wise IoU for 1:1 matched spans, i.e. the diagonal of
+    temporal_iou(spans1, spans2) without building the (N, M) map.
+
+    Args:
+        spans1: (N, 2) torch.Tensor, each row defines a span [st, ed]
+        spans2: (N, 2) torch.Tensor, matched row for row
+
+    Returns:
+        iou: (N, ) torch.Tensor
+        union: (N, ) torch.Tensor
+    """
+    areas1 = spans1[:, 1] - spans1[:, 0]  # (N, )
+    areas2 = spans2[:, 1] - spans2[:, 0]  # (N, )
+
+    left = torch.maximum(spans1[:, 0], spans2[:, 0])  # (N, )
+    right = torch.minimum(spans1[:, 1], spans2[:, 1])  # (N, )
+
+    inter = (right - left).clamp(min=0)  # (N, )
+    union = areas1 + areas2 - inter  # (N, )
+
+    iou = inter / union
+    return iou, union
+
+
 def temporal_intersection_over_pred(gt_spans, pred_spans):
     """ intersection over the second input spans
     Args:
@@ -122,22 +155,53 @@ def generalized_temporal_iou(spans1, spans2):
     tensor([[ 0.6667,  0.2000],
         [-0.2000,  0.5000]])
     """
-    spans1 = spans1.float()
-    spans2 = spans2.float()
+    if spans1.dtype != torch.float32:
+        spans1 = spans1.float()
+    if spans2.dtype != torch.float32:
+        spans2 = spans2.float()
     assert (spans1[:, 1] >= spans1[:, 0]).all()
     assert (spans2[:, 1] >= spans2[:, 0]).all()
-    iou, union = temporal_iou(spans1, spans2)
 
-    left = torch.min(spans1[:, None, 0], spans2[:, 0])  # (N, M)
-    right = torch.max(spans1[:, None, 1], spans2[:, 1])  # (N, M)
-    enclosing_area = (right - left).clamp(min=0)  # (N, M)
+    # one elementwise min/max pair yields all four boundary maps:
+    # lo = (enclosing_left, inter_right), hi = (inter_left, enclosing_right)
+    lo = torch.minimum(spans1[:, None, :], spans2)  # (N, M, 2)
+    hi = torch.maximum(spans1[:, None, :], spans2)  # (N, M, 2)
+
+    areas1 = spans1[:, 1] - spans1[:, 0]  # (N, )
+    areas2 = spans2[:, 1] - spans2[:, 0]  # (M, )
+
+    inter = (lo[..., 1] - hi[..., 0]).clamp(min=0)  # (N, M)
+    union = areas1[:, None] + areas2 - inter  # (N, M)
+    iou = inter / union
+
+    enclosing_area = (hi[..., 1] - lo[..., 0]).clamp(min=0)  # (N, M)
 
     return iou - (enclosing_area - union) / enclosing_area
 
 
+def _windowed_row_max(v2v_sims, idx, c0, c1):
+    """Per-row max of v2v_sims[idx, :, c0:c1 + 1] for every span.
+
+    The table only depends on the (sample, column window) triple, so it is
+    computed once per unique triple; the reduction itself is one batched
+    masked max, with no per-window kernels or host round trips.
+    """
+    vid_len = v2v_sims.shape[1]
+    idx = idx.to(v2v_sims.device)
+    keys = torch.stack([idx, c0, c1], dim=1)
+    uniq, inv = torch.unique(keys, dim=0, return_inverse=True)
+
+    cols = torch.arange(vid_len, device=v2v_sims.device)
+    in_window = (cols >= uniq[:, 1, None]) & (cols <= uniq[:, 2, None])  # (K, vid_len)
+    masked = v2v_sims[uniq[:, 0]].masked_fill(~in_window[:, None, :], float('-inf'))
+    row_max = masked.max(dim=2)[0]  # (K, vid_len)
+
+    return row_max[inv]
+
+
 ### When using new loss with pretrain dataset
 ### durations of pretrian dataset are various (120 ~ 150)
-def S_Diff(iou, spans1, spans2, logits, idx):
+def S_Diff(iou, spans1, spans2, logits, idx, cs=None):
     # spans1 = spans1.float()
     # spans2 = spans2.float()
 
@@ -150,38 +214,23 @@ def S_Diff(iou, spans1, spans2, logits, idx):
     # assert (spans1[:, 1] >= spans1[:, 0]).all()
     # assert (spans2[:, 1] >= spans2[:, 0]).all()
 
-    bsz, vid_len = logits.shape
-
-    src_spans = [[] for i in range(bsz)]
-    tgt_spans = [[] for i in range(bsz)]
-
-    for b, i in enumerate(idx):
-        src_spans[i].append(spans1[b].int().detach().cpu())
-        tgt_spans[i].append(spans2[b].int().detach().cpu())
-
-    sim_diffs = []
+    vid_len = logits.shape[1]
 
-    for i in range(bsz):
-        logit = logits[i]
+    # sometimes st is negative or end is larger than max_clip_len;
+    # clamp out of place: detach/long alias the caller's int64 spans, and an
+    # in-place clamp here invalidates the indices saved by a sibling term
+    s1 = spans1.detach().long().clamp(min=0, max=vid_len - 1)
+    s2 = spans2.detach().long().clamp(min=0, max=vid_len - 1)
+    src_st, src_end = s1[:, 0], s1[:, 1]
+    tgt_st, tgt_end = s2[:, 0], s2[:, 1]
 
-        for j in range(len(src_spans[i])):
-            
-            st, end = src_spans[i][j]
-            st, end = min(max(st, 0), vid_len - 1), min(end, vid_len - 1)  # sometimes st is negative or end is larger than max_clip_len
-            src_sim = logit[st:end + 1].mean()
-            if torch.isnan(src_sim):
-                print(f'\nsrc: {src_sim},vid_len: {vid_len} \nbefore {src_spans[i][j]}\nafter [{st}, {end}]')
+    # all span means in one gather over a padded cumsum, no per-span kernels
+    if cs is None:
+        cs = F.pad(logits.cumsum(dim=-1), (1, 0))
+    src_sims = (cs[idx, src_end + 1] - cs[idx, src_st]) / (src_end - src_st + 1).float()
+    tgt_sims = (cs[idx, tgt_end + 1] - cs[idx, tgt_st]) / (tgt_end - tgt_st + 1).float()
 
-            st, end = tgt_spans[i][j]
-            st, end = min(st, vid_len - 1), min(end, vid_len - 1)   # somtimes there are over-ranged gt window in pretrain dataset
-            tgt_sim = logit[st:end + 1].mean()
-            if torch.isnan(tgt_sim):
-                print(f'\ntgt: {tgt_sim}, \nbefore {tgt_spans[i][j]}\nafter [{st}, {end}]')
-
-            sim_diff = torch.abs(src_sim - tgt_sim)  # L1 distance
-            sim_diffs.append(sim_diff) 
-
-    sim_diffs = torch.stack(sim_diffs, dim=0)
+    sim_diffs = torch.abs(src_sims - tgt_sims)  # L1 distance
 
     # iou = torch.diag(iou)
     # new_iou = iou - (1 - iou) * sim_diffs
@@ -191,115 +240,66 @@ def S_Diff(iou, spans1, spans2, logits, idx):
     return sim_diff_term
 
 
-def S_GT_P(iou, src_spans, tgt_spans, v2v_sims):  # S(Gt-P)
-    bsz, vid_len, _ = v2v_sims.shape
-
-    # src_spans = [[] for i in range(bsz)]  # prediction
-    # tgt_spans = [[] for i in range(bsz)]
-
-    # for b, i in enumerate(idx):
-    #     src_spans[i].append(spans1[b].int().detach().cpu())
-    #     tgt_spans[i].append(spans2[b].int().detach().cpu())
+def S_GT_P(iou, spans1, spans2, v2v_sims, idx):  # S(Gt-P)
+    vid_len = v2v_sims.shape[1]
 
-    i2i_sims = []
-    for i in range(bsz):
-        v2v_sim = v2v_sims[i]
+    s1 = spans1.detach().long().clamp(min=0, max=vid_len - 1)
+    s2 = spans2.detach().long().clamp(min=0, max=vid_len - 1)
+    r0, r1 = s1[:, 0], s1[:, 1]
+    c0, c1 = s2[:, 0], s2[:, 1]
 
-        for j in range(len(src_spans[i])):
-            
-            st, end = int(src_spans[i][j][0]), int(src_spans[i][j][1])
-            # st, end = min(max(st, 0), vid_len - 1), min(end, vid_len - 1)  # sometime st is negative value
-            # src_feat = vid_feat[st:end + 1].mean(dim=0)
-            i2i_sim = v2v_sim[st: end + 1, :]
-
-            st, end = int(tgt_spans[i][j][0]), int(tgt_spans[i][j][1])
-            # st, end = min(st, vid_len - 1), min(end, vid_len - 1)
-            # tgt_feat = vid_feat[st:end + 1].mean(dim=0)
-            i2i_sim = i2i_sim[:, st: end + 1]
-
-            i2i_sim = i2i_sim.flatten().mean()
-
-            # i2i_sim = src_feat @ tgt_feat.t()
-            # i2i_sims.append(i2i_sim)
-            i2i_sims.append(i2i_sim)
-
-    i2i_sims = torch.stack(i2i_sims, dim=0)
+    # mean of v2v_sim[src, tgt] for every span pair via one summed-area table
+    ii = F.pad(v2v_sims.cumsum(1).cumsum(2), (1, 0, 1, 0))
+    sums = ii[idx, r1 + 1, c1 + 1] - ii[idx, r0, c1 + 1] - ii[idx, r1 + 1, c0] + ii[idx, r0, c0]
+    i2i_sims = sums / ((r1 - r0 + 1) * (c1 - c0 + 1)).float()
 
     # iou = torch.diag(iou)
-    
+
     # new_iou = iou - (1 - iou) * (1 - i2i_sims)
     sim_gt_p_term = (1 - iou) * (1 - i2i_sims)
 
     return sim_gt_p_term
 
 def S_GT_P_2(iou, spans1, spans2, v2v_sims, idx):  # S(Gt-P) ver2: pred-gt
-    bsz, vid_len, _ = v2v_sims.shape
-
-    src_spans = [[] for i in range(bsz)]  #pred
-    tgt_spans = [[] for i in range(bsz)]  #gt
-
-    for b, i in enumerate(idx):
-        src_spans[i].append(spans1[b].int().detach().cpu())
-        tgt_spans[i].append(spans2[b].int().detach().cpu())
-
-    i2i_sims = []
-    for i in range(bsz):
-        v2v_sim = v2v_sims[i]
+    vid_len = v2v_sims.shape[1]
 
-        for j in range(len(src_spans[i])):
-            
-            st, end = src_spans[i][j]
-            st, end = min(max(st, 0), vid_len - 1), min(end, vid_len - 1)  # sometime st is negative value
-            i2i_sim = v2v_sim[st: end + 1, :]
+    s1 = spans1.detach().long().clamp(min=0, max=vid_len - 1)  #pred, sometime st is negative value
+    s2 = spans2.detach().long().clamp(min=0, max=vid_len - 1)  #gt
+    r0, r1 = s1[:, 0], s1[:, 1]
+    c0, c1 = s2[:, 0], s2[:, 1]
 
-            st, end = tgt_spans[i][j]
-            st, end = min(st, vid_len - 1), min(end, vid_len - 1)
-            i2i_sim = i2i_sim[:, st: end + 1]
+    # per-row max over the gt window from a shared table, then a cumsum
+    # over the row maxes turns the mean over the pred window into a gather
+    row_max = _windowed_row_max(v2v_sims, idx, c0, c1)
 
-            i2i_sim = i2i_sim.max(dim=1)[0].mean()
-
-            i2i_sims.append(i2i_sim)
-
-    i2i_sims = torch.stack(i2i_sims, dim=0)
+    rcs = F.pad(row_max.cumsum(-1), (1, 0))
+    k = torch.arange(r0.numel(), device=v2v_sims.device)
+    i2i_sims = (rcs[k, r1 + 1] - rcs[k, r0]) / (r1 - r0 + 1).float()
 
     sim_gt_p_term = (1 - iou) * (1 - i2i_sims)
 
     return sim_gt_p_term
 
 def S_GT_P_3(iou, spans1, spans2, v2v_sims, idx):  # S(Gt-P) ver3: gt-pred
-    bsz, vid_len, _ = v2v_sims.shape
-
-    src_spans = [[] for i in range(bsz)]  #pred
-    tgt_spans = [[] for i in range(bsz)]  #gt
-
-    for b, i in enumerate(idx):
-        src_spans[i].append(spans1[b].int().detach().cpu())
-        tgt_spans[i].append(spans2[b].int().detach().cpu())
-
-    i2i_sims = []
-    for i in range(bsz):
-        v2v_sim = v2v_sims[i]
+    vid_len = v2v_sims.shape[1]
 
-        for j in range(len(src_spans[i])):
-            st, end = tgt_spans[i][j]
-            st, end = min(st, vid_len - 1), min(end, vid_len - 1)
-            i2i_sim = v2v_sim[st: end + 1, :]
+    s1 = spans1.detach().long().clamp(min=0, max=vid_len - 1)  #pred, sometime st is negative value
+    s2 = spans2.detach().long().clamp(min=0, max=vid_len - 1)  #gt
+    r0, r1 = s2[:, 0], s2[:, 1]
+    c0, c1 = s1[:, 0], s1[:, 1]
 
-            st, end = src_spans[i][j]
-            st, end = min(max(st, 0), vid_len - 1), min(end, vid_len - 1)  # sometime st is negative value
-            i2i_sim = i2i_sim[:, st: end + 1]
+    # same as ver2 with gt rows and pred columns
+    row_max = _windowed_row_max(v2v_sims, idx, c0, c1)
 
-            i2i_sim = i2i_sim.max(dim=1)[0].mean()
-
-            i2i_sims.append(i2i_sim)
-
-    i2i_sims = torch.stack(i2i_sims, dim=0)
+    rcs = F.pad(row_max.cumsum(-1), (1, 0))
+    k = torch.arange(r0.numel(), device=v2v_sims.device)
+    i2i_sims = (rcs[k, r1 + 1] - rcs[k, r0]) / (r1 - r0 + 1).float()
 
     sim_gt_p_term = (1 - iou) * (1 - i2i_sims)
 
     return sim_gt_p_term
 
-def S_Q_P(iou, spans, logits, idx):  # S(Q-P)
+def S_Q_P(iou, spans, logits, idx, cs=None):  # S(Q-P)
     # spans1 = spans1.float()
     # spans2 = spans2.float()
 
@@ -310,27 +310,15 @@ def S_Q_P(iou, spans, logits, idx):  # S(Q-P)
     
     # assert (spans[:, 1] >= spans[:, 0]).all()
 
-    bsz, vid_len = logits.shape
-
-    src_spans = [[] for i in range(bsz)]
-
-    for b, i in enumerate(idx):
-        src_spans[i].append(spans[b].int().detach().cpu())
+    vid_len = logits.shape[1]
 
-    t2i_sims = []
-    # src_sims = []
-    for i in range(bsz):
-        logit = logits[i]
+    # sometime st is negative value
+    s = spans.detach().long().clamp(min=0, max=vid_len - 1)
+    st, end = s[:, 0], s[:, 1]
 
-        for j in range(len(src_spans[i])):
-        
-            st, end = src_spans[i][j]
-            st, end = min(max(st, 0), vid_len - 1), min(end, vid_len - 1)  # sometime st is negative value
-            src_sim = logit[st:end + 1].mean()
-
-            t2i_sims.append(src_sim)
-
-    t2i_sims = torch.stack(t2i_sims, dim=0)
+    if cs is None:
+        cs = F.pad(logits.cumsum(dim=-1), (1, 0))
+    t2i_sims = (cs[idx, end + 1] - cs[idx, st]) / (end - st + 1).float()
 
     # iou = torch.diag(iou)
     # new_iou = iou - (1 - iou) * (1 - t2i_sims)
@@ -341,13 +329,14 @@ def S_Q_P(iou, spans, logits, idx):  # S(Q-P)
 
 
 def distance_term(spans1, spans2):
-    left = torch.min(spans1[:, None, 0], spans2[:, 0])  # (N, M)
-    right = torch.max(spans1[:, None, 1], spans2[:, 1])  # (N, M)
-    
-    enclosing_area = torch.diag((right - left).clamp(min=0))  # (N, M)
+    # only the matched diagonal is used, so everything stays elementwise (N, )
+    left = torch.minimum(spans1[:, 0], spans2[:, 0])  # (N, )
+    right = torch.maximum(spans1[:, 1], spans2[:, 1])  # (N, )
 
-    center1 = torch.diag((spans1[:, None, 0] + spans1[:, None, 1]) / 2)
-    center2 = (spans2[:, 0] + spans2[:, 1]) / 2
+    enclosing_area = (right - left).clamp(min=0)  # (N, )
+
+    center1 = span_xx_to_cxw(spans1)[:, 0]
+    center2 = span_xx_to_cxw(spans2)[:, 0]
     center_dist = torch.abs(center2 - center1)
 
     distance = center_dist / (enclosing_area ** 2)
@@ -355,15 +344,13 @@ def distance_term(spans1, spans2):
     return distance
 
 def new_loss(iou_loss_types, spans1, spans2, sims, idx, durations):
-    spans1 = span_cxw_to_xx(spans1).float()
-    spans2 = span_cxw_to_xx(spans2).float()
-
-    iou, _ = temporal_iou(spans1, spans2)
-    iou = torch.diag(iou)
+    # the matcher builds idx on CPU from the numpy assignment; move it once
+    # so every gather below and the bincount run on the spans' device
+    idx = idx.to(spans1.device, non_blocking=True)
 
     if not 2 in iou_loss_types:
         sims = sims[0]
-        bsz, vid_clip_len = sims.shape[1]
+        bsz, vid_clip_len = sims.shape[:2]
 
     else:
         if len(iou_loss_types) > 1:
@@ -372,34 +359,57 @@ def new_loss(iou_loss_types, spans1, spans2, sims, idx, durations):
             vid_feat = sims[1]
 
         bsz, vid_clip_len, _ = vid_feat.shape
-    
+
+    ### save_pred2
+    src_windows = span_cxw_to_window(spans1.detach().cpu(), durations, [bsz, idx])
+    tgt_windows = span_cxw_to_window(spans2.detach().cpu(), durations, [bsz, idx])
+
+    spans1 = span_cxw_to_xx(spans1)
+    spans2 = span_cxw_to_xx(spans2)
+    if spans1.dtype != torch.float32:
+        spans1 = spans1.float()
+    if spans2.dtype != torch.float32:
+        spans2 = spans2.float()
+
+    # spans are matched 1:1 here, so only the paired O(N) term is needed
+    iou, _ = temporal_iou_paired(spans1, spans2)
+
     assert (spans1[:, 1] >= spans1[:, 0]).all()
     assert (spans2[:, 1] >= spans2[:, 0]).all()
 
-    ### save_pred2
-    spans1 = span_cxw_to_window(spans1.detach().cpu(), durations, [bsz, idx])
-    spans2 = span_cxw_to_window(spans2.detach().cpu(), durations, [bsz, idx])
+    # [spans1, spans2] == [start clip number, end clip number], kept on device
+    s1 = (spans1 * vid_clip_len).round_().long()
+    s2 = (spans2 * vid_clip_len).round_().long()
 
     new_loss = 1 - iou
 
+    # the terms share one padded cumsum of the similarity logits
+    cs = None
+    if 1 in iou_loss_types or 3 in iou_loss_types:
+        cs = F.pad(sims.cumsum(dim=-1), (1, 0))
+
     if 1 in iou_loss_types:
-        new_loss += S_Diff(iou, spans1, spans2, sims, idx)
+        new_loss += S_Diff(iou, s1, s2, sims, idx, cs=cs)
 
     if 2 in iou_loss_types:
-        new_loss += S_GT_P(iou, spans1, spans2, vid_feat) 
-    
-    if 3 in iou_loss_types:
-        new_loss += S_Q_P(iou, spans1, sims, idx)
-
-    ### save_pred  
-    ious = [[] for i in range(bsz)]
-    sim_losses = [[] for i in range(bsz)]
+        new_loss += S_GT_P(iou, s1, s2, vid_feat, idx)
 
-    for b, i in enumerate(idx):
-        ious[i].append(iou[b].item())
-        sim_losses[i].append(new_loss[b].item())
-
-    return new_loss, {'src_spans': spans1,
-                      'tgt_spans': spans2,
+    if 3 in iou_loss_types:
+        new_loss += S_Q_P(iou, s1, sims, idx, cs=cs)
+
+    ### save_pred
+    # idx is sorted by construction, so per-sample groups are contiguous runs
+    counts = torch.bincount(idx, minlength=bsz).cpu().tolist()
+    stats_list = torch.stack([iou, new_loss], dim=1).detach().cpu().tolist()
+
+    ious, sim_losses = [], []
+    off = 0
+    for n in counts:
+        ious.append([row[0] for row in stats_list[off:off + n]])
+        sim_losses.append([row[1] for row in stats_list[off:off + n]])
+        off += n
+
+    return new_loss, {'src_spans': src_windows,
+                      'tgt_spans': tgt_windows,
                       'ious': ious,
                       'sim_losses': sim_losses}
\ No newline at end of file